@@ -1,7 +1,8 @@
 import builtins
 import functools
+from collections import Counter
 from collections.abc import Callable
-from typing import Any, TypeVar, cast
+from typing import Any, Literal, TypeVar, cast
 
 import hypothesis.extra.numpy as npst
 import hypothesis.strategies as st
@@ -15,9 +16,9 @@ from hypothesis.stateful import (
     rule,
 )
 from hypothesis.strategies import DataObject
+from sortedcontainers import SortedList
 
 import zarr
-from zarr import Array
 from zarr.abc.store import Store
 from zarr.codecs.bytes import BytesCodec
 from zarr.core.buffer import Buffer, BufferPrototype, cpu, default_buffer_prototype
@@ -33,6 +34,7 @@ from zarr.testing.strategies import (
     orthogonal_indices,
 )
 from zarr.testing.strategies import keys as zarr_keys
+from zarr.types import AnyArray
 
 MAX_BINARY_SIZE = 100
 
@@ -51,10 +53,9 @@ def with_frequency(frequency: float) -> Callable[[F], F]:
 
         @precondition
         def frequency_check(f: Any) -> Any:
-            if not hasattr(f, counter_attr):
-                setattr(f, counter_attr, 0)
-
-            current_count = getattr(f, counter_attr) + 1
+            # The counter lives on the state machine instance (not in this closure) so
+            # that it restarts with every example.
+            current_count = getattr(f, counter_attr, 0) + 1
             setattr(f, counter_attr, current_count)
 
             return (current_count * frequency) % 1.0 >= (1.0 - frequency)
@@ -64,6 +65,36 @@ def with_frequency(frequency: float) -> Callable[[F], F]:
     return decorator
 
 
+def read_only(func: F) -> F:
+    """Mark a rule as never modifying the store, see `skip_after_read_only`."""
+
+    @functools.wraps(func)
+    def wrapper(self: Any, *args: Any, **kwargs: Any) -> Any:
+        # A fresh token per call lets every invariant skip exactly once after this rule
+        self._read_only_token = object()
+        return func(self, *args, **kwargs)
+
+    return cast(F, wrapper)
+
+
+def skip_after_read_only(func: F) -> F:
+    """Skip an invariant directly after a rule marked with `read_only`.
+
+    Unmarked rules are assumed to modify the store, so a missing mark only costs time.
+    """
+    seen_attr = f"__{func.__name__}_read_only_token"
+
+    @functools.wraps(func)
+    def wrapper(self: Any, *args: Any, **kwargs: Any) -> Any:
+        token = getattr(self, "_read_only_token", None)
+        if token is not None and getattr(self, seen_attr, None) is not token:
+            setattr(self, seen_attr, token)
+            return None
+        return func(self, *args, **kwargs)
+
+    return cast(F, wrapper)
+
+
 def split_prefix_name(path: str) -> tuple[str, str]:
     split = path.rsplit("/", maxsplit=1)
     if len(split) > 1:
@@ -90,19 +121,85 @@ class ZarrHierarchyStateMachine(SyncMixin, RuleBasedStateMachine):
         self.model = MemoryStore()
         zarr.group(store=self.model)
 
-        # Track state of the hierarchy, these should contain fully qualified paths
-        self.all_groups: set[str] = set()
-        self.all_arrays: set[str] = set()
+        # The documents written by creating the root group. Resets write these directly
+        # rather than going through `zarr.group` every time.
+        self._root_group_docs: dict[str, Buffer] = {}
+        for key in self._sync_iter(self.model.list()):
+            buf = self._sync(self.model.get(key, prototype=default_buffer_prototype()))
+            assert buf is not None
+            self._root_group_docs[key] = buf
+
+        # Track state of the hierarchy, these should contain fully qualified paths.
+        # Kept sorted for prefix range queries and a stable sampling order. Only modify
+        # them through `_track`, `_untrack` and `_untrack_prefix`.
+        self.all_groups: SortedList[str] = SortedList()
+        self.all_arrays: SortedList[str] = SortedList()
+        # Metadata keys that must exist for every tracked node, kept in sync with the above
+        self._expected_keys: set[str] = set()
+
+        # Opened model array handles, keyed by path. Must be cleared whenever an array
+        # may be deleted or its metadata changed. Arrays in the store under test are
+        # always reopened so that its metadata is re-read on every rule.
+        self._array_cache: dict[str, AnyArray] = {}
+
+        # Strategies sampling from all_groups/all_arrays, rebuilt only when those change
+        self._groups_strategy: st.SearchStrategy[str] = st.nothing()
+        self._arrays_strategy: st.SearchStrategy[str] = st.nothing()
 
     @initialize()
     def init_store(self) -> None:
         # This lets us reuse the fixture provided store.
         self._sync(self.store.clear())
-        zarr.group(store=self.store)
+        self._create_root_group(self.store)
 
     def can_add(self, path: str) -> bool:
         return path not in self.all_groups and path not in self.all_arrays
 
+    def _create_root_group(self, store: Store) -> None:
+        for key, buf in self._root_group_docs.items():
+            self._sync(store.set(key, buf))
+
+    def _open_model_array(self, path: str) -> AnyArray:
+        arr = self._array_cache.get(path)
+        if arr is None:
+            arr = zarr.open_array(path=path, store=self.model)
+            self._array_cache[path] = arr
+        return arr
+
+    def _update_strategies(self) -> None:
+        # Must be called after every change to all_groups or all_arrays
+        self._groups_strategy = (
+            st.sampled_from(tuple(self.all_groups)) if self.all_groups else st.nothing()
+        )
+        self._arrays_strategy = (
+            st.sampled_from(tuple(self.all_arrays)) if self.all_arrays else st.nothing()
+        )
+
+    def _track(self, path: str, kind: Literal["group", "array"]) -> None:
+        nodes = self.all_groups if kind == "group" else self.all_arrays
+        nodes.add(path)
+        self._expected_keys.add(f"{path}/zarr.json")
+        self._update_strategies()
+
+    def _forget(self, path: str) -> None:
+        self._expected_keys.discard(f"{path}/zarr.json")
+        self._array_cache.pop(path, None)
+
+    def _untrack(self, path: str) -> None:
+        self.all_groups.discard(path)
+        self.all_arrays.discard(path)
+        self._forget(path)
+        self._update_strategies()
+
+    def _untrack_prefix(self, prefix: str) -> None:
+        # Every node starting with `prefix` sorts within [prefix, prefix + max code point),
+        # so a range query on the sorted containers finds all matches.
+        for nodes in (self.all_groups, self.all_arrays):
+            for node in list(nodes.irange(prefix, prefix + "\U0010ffff")):
+                nodes.remove(node)
+                self._forget(node)
+        self._update_strategies()
+
     # -------------------- store operations -----------------------
     @rule(name=node_names, data=st.data())
     def add_group(self, name: str, data: DataObject) -> None:
@@ -110,13 +207,13 @@ class ZarrHierarchyStateMachine(SyncMixin, RuleBasedStateMachine):
         if isinstance(self.store, LocalStore):
             name = name.lower()
         if self.all_groups:
-            parent = data.draw(st.sampled_from(sorted(self.all_groups)), label="Group parent")
+            parent = data.draw(self._groups_strategy, label="Group parent")
         else:
             parent = ""
         path = f"{parent}/{name}".lstrip("/")
         assume(self.can_add(path))
         note(f"Adding group: path='{path}'")
-        self.all_groups.add(path)
+        self._track(path, "group")
         zarr.group(store=self.store, path=path)
         zarr.group(store=self.model, path=path)
 
@@ -133,7 +230,7 @@ class ZarrHierarchyStateMachine(SyncMixin, RuleBasedStateMachine):
         array, chunks = array_and_chunks
         fill_value = data.draw(npst.from_dtype(array.dtype))
         if self.all_groups:
-            parent = data.draw(st.sampled_from(sorted(self.all_groups)), label="Array parent")
+            parent = data.draw(self._groups_strategy, label="Array parent")
         else:
             parent = ""
         # TODO: support creating deeper paths
@@ -155,13 +252,12 @@ class ZarrHierarchyStateMachine(SyncMixin, RuleBasedStateMachine):
                 # Chose bytes codec to avoid wasting time compressing the data being written
                 codecs=[BytesCodec()],
             )
-        self.all_arrays.add(path)
+        self._track(path, "array")
 
     @rule()
     @with_frequency(0.25)
     def clear(self) -> None:
         note("clearing")
-        import zarr
 
         self._sync(self.store.clear())
         self._sync(self.model.clear())
@@ -169,22 +265,19 @@ class ZarrHierarchyStateMachine(SyncMixin, RuleBasedStateMachine):
         assert self._sync(self.store.is_empty("/"))
         assert self._sync(self.model.is_empty("/"))
 
-        self.all_groups.clear()
-        self.all_arrays.clear()
+        self._untrack_prefix("")
 
-        zarr.group(store=self.store)
-        zarr.group(store=self.model)
+        self._create_root_group(self.store)
+        self._create_root_group(self.model)
 
         # TODO: MemoryStore is broken?
         # assert not self._sync(self.store.is_empty("/"))
         # assert not self._sync(self.model.is_empty("/"))
 
     def draw_directory(self, data: DataObject) -> str:
-        group_st = st.sampled_from(sorted(self.all_groups)) if self.all_groups else st.nothing()
-        array_st = st.sampled_from(sorted(self.all_arrays)) if self.all_arrays else st.nothing()
-        array_or_group = data.draw(st.one_of(group_st, array_st))
+        array_or_group = data.draw(st.one_of(self._groups_strategy, self._arrays_strategy))
         if data.draw(st.booleans()) and array_or_group in self.all_arrays:
-            arr = zarr.open_array(path=array_or_group, store=self.model)
+            arr = self._open_model_array(array_or_group)
             path = data.draw(
                 st.one_of(
                     st.sampled_from([array_or_group]),
@@ -199,6 +292,7 @@ class ZarrHierarchyStateMachine(SyncMixin, RuleBasedStateMachine):
 
     @precondition(lambda self: bool(self.all_groups))
     @rule(data=st.data())
+    @read_only
     def check_list_dir(self, data: DataObject) -> None:
         path = self.draw_directory(data)
         note(f"list_dir for {path=!r}")
@@ -215,8 +309,8 @@ class ZarrHierarchyStateMachine(SyncMixin, RuleBasedStateMachine):
     @precondition(lambda self: bool(self.all_arrays))
     @rule(data=st.data())
     def delete_chunk(self, data: DataObject) -> None:
-        array = data.draw(st.sampled_from(sorted(self.all_arrays)))
-        arr = zarr.open_array(path=array, store=self.model)
+        array = data.draw(self._arrays_strategy)
+        arr = self._open_model_array(array)
         chunk_path = data.draw(chunk_paths(ndim=arr.ndim, numblocks=arr.cdata_shape, subset=False))
         path = f"{array}/c/{chunk_path}"
         note(f"deleting chunk {path=!r}")
@@ -225,17 +319,18 @@ class ZarrHierarchyStateMachine(SyncMixin, RuleBasedStateMachine):
 
     @precondition(lambda self: bool(self.all_arrays))
     @rule(data=st.data())
+    @read_only
     def check_array(self, data: DataObject) -> None:
-        path = data.draw(st.sampled_from(sorted(self.all_arrays)))
+        path = data.draw(self._arrays_strategy)
         actual = zarr.open_array(self.store, path=path)[:]
-        expected = zarr.open_array(self.model, path=path)[:]
+        expected = self._open_model_array(path)[:]
         np.testing.assert_equal(actual, expected)
 
     @precondition(lambda self: bool(self.all_arrays))
     @rule(data=st.data())
     def overwrite_array_basic_indexing(self, data: DataObject) -> None:
-        array = data.draw(st.sampled_from(sorted(self.all_arrays)))
-        model_array = zarr.open_array(path=array, store=self.model)
+        array = data.draw(self._arrays_strategy)
+        model_array = self._open_model_array(array)
         store_array = zarr.open_array(path=array, store=self.store)
         slicer = data.draw(basic_indices(shape=model_array.shape))
         note(f"overwriting array with basic indexer: {slicer=}")
@@ -248,8 +343,8 @@ class ZarrHierarchyStateMachine(SyncMixin, RuleBasedStateMachine):
     @precondition(lambda self: bool(self.all_arrays))
     @rule(data=st.data())
     def overwrite_array_orthogonal_indexing(self, data: DataObject) -> None:
-        array = data.draw(st.sampled_from(sorted(self.all_arrays)))
-        model_array = zarr.open_array(path=array, store=self.model)
+        array = data.draw(self._arrays_strategy)
+        model_array = self._open_model_array(array)
         store_array = zarr.open_array(path=array, store=self.store)
         indexer, _ = data.draw(orthogonal_indices(shape=model_array.shape))
         note(f"overwriting array orthogonal {indexer=}")
@@ -262,8 +357,8 @@ class ZarrHierarchyStateMachine(SyncMixin, RuleBasedStateMachine):
     @precondition(lambda self: bool(self.all_arrays))
     @rule(data=st.data())
     def resize_array(self, data: DataObject) -> None:
-        array = data.draw(st.sampled_from(sorted(self.all_arrays)))
-        model_array = zarr.open_array(path=array, store=self.model)
+        array = data.draw(self._arrays_strategy)
+        model_array = self._open_model_array(array)
         store_array = zarr.open_array(path=array, store=self.store)
         ndim = model_array.ndim
         new_shape = tuple(
@@ -278,6 +373,7 @@ class ZarrHierarchyStateMachine(SyncMixin, RuleBasedStateMachine):
         note(f"resizing array from {model_array.shape} to {new_shape}")
         model_array.resize(new_shape)
         store_array.resize(new_shape)
+        self._array_cache.pop(array, None)
 
     @precondition(lambda self: bool(self.all_arrays) or bool(self.all_groups))
     @rule(data=st.data())
@@ -287,12 +383,7 @@ class ZarrHierarchyStateMachine(SyncMixin, RuleBasedStateMachine):
         self._sync(self.model.delete_dir(path))
         self._sync(self.store.delete_dir(path))
 
-        matches = set()
-        for node in self.all_groups | self.all_arrays:
-            if node.startswith(path):
-                matches.add(node)
-        self.all_groups = self.all_groups - matches
-        self.all_arrays = self.all_arrays - matches
+        self._untrack_prefix(path)
 
     # @precondition(lambda self: bool(self.all_groups))
     # @precondition(lambda self: bool(self.all_arrays))
@@ -328,16 +419,14 @@ class ZarrHierarchyStateMachine(SyncMixin, RuleBasedStateMachine):
     @precondition(lambda self: len(self.all_arrays) >= 1)
     @rule(data=st.data())
     def delete_array_using_del(self, data: DataObject) -> None:
-        array_path = data.draw(
-            st.sampled_from(sorted(self.all_arrays)), label="Array deletion target"
-        )
+        array_path = data.draw(self._arrays_strategy, label="Array deletion target")
         prefix, array_name = split_prefix_name(array_path)
         note(f"Deleting array '{array_path}' ({prefix=!r}, {array_name=!r}) using del")
         for store in [self.model, self.store]:
             group = zarr.open_group(path=prefix, store=store)
             group[array_name]  # check that it exists
             del group[array_name]
-        self.all_arrays.remove(array_path)
+        self._untrack(array_path)
 
     @precondition(lambda self: self.store.supports_deletes)
     @precondition(lambda self: len(self.all_groups) >= 2)  # fixme don't delete root
@@ -345,23 +434,19 @@ class ZarrHierarchyStateMachine(SyncMixin, RuleBasedStateMachine):
     def delete_group_using_del(self, data: DataObject) -> None:
         # ensure that we don't include the root group in the list of member names that we try
         # to delete
-        member_names = tuple(filter(lambda v: "/" in v, sorted(self.all_groups)))
+        member_names = tuple(filter(lambda v: "/" in v, self.all_groups))
         group_path = data.draw(st.sampled_from(member_names), label="Group deletion target")
         prefix, group_name = split_prefix_name(group_path)
         note(f"Deleting group '{group_path=!r}', {prefix=!r}, {group_name=!r} using delete")
-        members = zarr.open_group(store=self.model, path=group_path).members(max_depth=None)
-        for _, obj in members:
-            if isinstance(obj, Array):
-                self.all_arrays.remove(obj.path)
-            else:
-                self.all_groups.remove(obj.path)
+        # Our tracked state already knows every descendant, no need to walk the hierarchy
+        self._untrack_prefix(f"{group_path}/")
         for store in [self.store, self.model]:
             group = zarr.open_group(store=store, path=prefix)
             group[group_name]  # check that it exists
             del group[group_name]
         if group_path != "/":
             # The root group is always present
-            self.all_groups.remove(group_path)
+            self._untrack(group_path)
 
     # # --------------- assertions -----------------
     # def check_group_arrays(self, group):
@@ -406,18 +491,22 @@ class ZarrHierarchyStateMachine(SyncMixin, RuleBasedStateMachine):
     #     t1 = time.time()
     #     note(f"Checks took {t1 - t0} sec.")
     @invariant()
+    @skip_after_read_only
     def check_list_prefix_from_root(self) -> None:
         model_list = self._sync_iter(self.model.list_prefix(""))
         store_list = self._sync_iter(self.store.list_prefix(""))
         note(f"Checking {len(model_list)} expected keys vs {len(store_list)} actual keys")
-        assert sorted(model_list) == sorted(store_list), (
+        model_counts, store_counts = Counter(model_list), Counter(store_list)
+        # Multiset comparison, only sort to produce a readable failure message
+        assert model_counts == store_counts, (
             sorted(model_list),
             sorted(store_list),
         )
 
-        # check that our internal state matches that of the store and model
-        assert all(f"{path}/zarr.json" in model_list for path in self.all_groups | self.all_arrays)
-        assert all(f"{path}/zarr.json" in store_list for path in self.all_groups | self.all_arrays)
+        # check that our internal state matches that of the store and model, reusing the
+        # hashed listings above rather than building more sets
+        assert model_counts.keys() >= self._expected_keys
+        assert store_counts.keys() >= self._expected_keys
 
 
 class SyncStoreWrapper(zarr.core.sync.SyncMixin):
@@ -449,6 +538,12 @@ class SyncStoreWrapper(zarr.core.sync.SyncMixin):
     ) -> builtins.list[Buffer | None]:
         return self._sync(self.store.get_partial_values(prototype=prototype, key_ranges=key_ranges))
 
+    def get_all(
+        self, keys: builtins.list[str], prototype: BufferPrototype
+    ) -> builtins.list[Buffer | None]:
+        # Fetch whole values for all keys with a single trip through the event loop
+        return self.get_partial_values([(key, None) for key in keys], prototype)
+
     def delete(self, path: str) -> None:
         return self._sync(self.store.delete(path))
 
@@ -503,6 +598,11 @@ class ZarrStoreStateMachine(RuleBasedStateMachine):
         self.model: dict[str, Buffer] = {}
         self.store = SyncStoreWrapper(store)
         self.prototype = default_buffer_prototype()
+        # Buffers already built for a given value; hypothesis replays the same values a lot
+        # while shrinking. Bounded by clear().
+        self._buf_cache: dict[bytes, Buffer] = {}
+        # Number of check_store_state runs, used to pick which key to check `exists` on
+        self._num_state_checks = 0
 
     @initialize()
     def init_store(self) -> None:
@@ -512,12 +612,16 @@ class ZarrStoreStateMachine(RuleBasedStateMachine):
     def set(self, key: str, data: bytes) -> None:
         note(f"(set) Setting {key!r} with {data!r}")
         assert not self.store.read_only
-        data_buf = cpu.Buffer.from_bytes(data)
+        data_buf = self._buf_cache.get(data)
+        if data_buf is None:
+            data_buf = cpu.Buffer.from_bytes(data)
+            self._buf_cache[data] = data_buf
         self.store.set(key, data_buf)
         self.model[key] = data_buf
 
     @precondition(lambda self: len(self.model.keys()) > 0)
     @rule(key=zarr_keys(), data=st.data())
+    @read_only
     def get(self, key: str, data: DataObject) -> None:
         key = data.draw(
             st.sampled_from(sorted(self.model.keys()))
@@ -528,6 +632,7 @@ class ZarrStoreStateMachine(RuleBasedStateMachine):
         assert self.model[key] == store_value
 
     @rule(key=zarr_keys(), data=st.data())
+    @read_only
     def get_invalid_zarr_keys(self, key: str, data: DataObject) -> None:
         note("(get_invalid)")
         assume(key not in self.model)
@@ -535,6 +640,7 @@ class ZarrStoreStateMachine(RuleBasedStateMachine):
 
     @precondition(lambda self: len(self.model.keys()) > 0)
     @rule(data=st.data())
+    @read_only
     def get_partial_values(self, data: DataObject) -> None:
         key_range = data.draw(
             key_ranges(keys=st.sampled_from(sorted(self.model.keys())), max_size=MAX_BINARY_SIZE)
@@ -577,6 +683,7 @@ class ZarrStoreStateMachine(RuleBasedStateMachine):
         note("(clear)")
         self.store.clear()
         self.model.clear()
+        self._buf_cache.clear()
 
         assert self.store.is_empty("")
 
@@ -585,6 +692,7 @@ class ZarrStoreStateMachine(RuleBasedStateMachine):
     @rule()
     # Local store can be non-empty when there are subdirectories but no files
     @precondition(lambda self: not isinstance(self.store.store, LocalStore))
+    @read_only
     def is_empty(self) -> None:
         note("(is_empty)")
 
@@ -592,41 +700,38 @@ class ZarrStoreStateMachine(RuleBasedStateMachine):
         assert self.store.is_empty("") == (not self.model)
 
     @rule(key=zarr_keys())
+    @read_only
     def exists(self, key: str) -> None:
         note("(exists)")
 
         assert self.store.exists(key) == (key in self.model)
 
     @invariant()
-    def check_paths_equal(self) -> None:
-        note("Checking that paths are equal")
-        paths = sorted(self.store.list())
-
-        assert sorted(self.model.keys()) == paths
+    @skip_after_read_only
+    def check_store_state(self) -> None:
+        note("Checking paths / num keys / exists / empty")
+        # List the store once and run all key-based checks against that listing
+        paths = self.store.list()
 
-    @invariant()
-    def check_vals_equal(self) -> None:
-        note("Checking values equal")
-        for key, val in self.model.items():
-            store_item = self.store.get(key, self.prototype)
-            assert val == store_item
-
-    @invariant()
-    def check_num_zarr_keys_equal(self) -> None:
-        note("check num zarr_keys equal")
+        assert Counter(self.model.keys()) == Counter(paths), (sorted(self.model), sorted(paths))
+        assert len(self.model) == len(paths)
 
-        assert len(self.model) == len(list(self.store.list()))
-
-    @invariant()
-    def check_zarr_keys(self) -> None:
-        keys = list(self.store.list())
-
-        if not keys:
+        if not paths:
             assert self.store.is_empty("") is True
 
         else:
             assert self.store.is_empty("") is False
 
-            for key in keys:
-                assert self.store.exists(key) is True
-        note("checking keys / exists / empty")
+            # Every listed key trivially exists for a consistent store, so rather than one
+            # round-trip per key, exercise `exists` on a single key. Picking it from the
+            # check count keeps this deterministic for hypothesis replaying.
+            self._num_state_checks += 1
+            assert self.store.exists(paths[self._num_state_checks % len(paths)]) is True
+
+    @invariant()
+    @skip_after_read_only
+    def check_vals_equal(self) -> None:
+        note("Checking values equal")
+        store_items = self.store.get_all(list(self.model), self.prototype)
+        for val, store_item in zip(self.model.values(), store_items, strict=True):
+            assert val == store_item